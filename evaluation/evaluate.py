@@ -1,11 +1,18 @@
 import os, sys
+import csv
+import contextlib
+import glob
 import json
+import shutil
 import argparse
 from tqdm import tqdm
 
+import numpy as np
 import pandas as pd
 import torch
+from torch.utils.data import Dataset, DataLoader
 from torchvision import models, transforms
+from torchvision.io import read_file, decode_image, ImageReadMode
 from PIL import Image
 import open_clip
 
@@ -15,6 +22,138 @@ from pycocoevalcap.spice.spice import Spice
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+def feature_similarity(features_1, features_2):
+    """
+    Row-wise cosine similarity of normalized features
+    """
+    return torch.einsum("nd,nd->n", features_1.float(), features_2.float())
+
+def shard_file_name(file_name: str, rank: int, world_size: int):
+    """
+    Add rank to file name if evaluation is sharded over multiple processes
+    """
+    if world_size <= 1:
+        return file_name
+    base, ext = os.path.splitext(file_name)
+    return f"{base}.rank{rank}{ext}"
+
+def merge_result_shards(experiment_folder: str, world_size: int):
+    """
+    Concatenate result files written by all ranks into single result file per evaluation
+    """
+    if world_size <= 1:
+        return
+    for first_shard in sorted(glob.glob(os.path.join(experiment_folder, "*.rank0.tsv"))):
+        file_name = first_shard[:-len(".rank0.tsv")] + ".tsv"
+        shards = [shard_file_name(file_name, rank, world_size) for rank in range(world_size)]
+        missing = [shard for shard in shards if not os.path.exists(shard)]
+        if len(missing) > 0:
+            # e.g. leftover shard of an earlier crashed run, keep existing result file untouched
+            print(f"Skipping merge of {file_name}, missing shards: {missing}")
+            continue
+        with open(file_name, "w", encoding="utf-8") as out:
+            for rank, shard in enumerate(shards):
+                with open(shard, "r", encoding="utf-8") as f:
+                    header = f.readline()
+                    if rank == 0:
+                        out.write(header)
+                    shutil.copyfileobj(f, out)
+                os.remove(shard)
+
+class ImageDataset(Dataset):
+    """
+    Dataset loading and preprocessing images from list of paths
+    """
+    def __init__(self, image_paths: list, preprocess) -> None:
+        self.image_paths = image_paths
+        self.preprocess = preprocess
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx: int):
+        return self.preprocess(Image.open(self.image_paths[idx]))
+
+class DecodedImageDataset(Dataset):
+    """
+    Dataset decoding images from list of paths into uint8 tensors, resizing and normalization is done on GPU
+    """
+    def __init__(self, image_paths: list) -> None:
+        self.image_paths = image_paths
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx: int):
+        try:
+            return decode_image(read_file(self.image_paths[idx]), mode=ImageReadMode.RGB)
+        except RuntimeError:
+            # fall back to PIL for image formats not supported by torchvision
+            return transforms.functional.pil_to_tensor(Image.open(self.image_paths[idx]).convert("RGB"))
+
+class CachedImageDataset(Dataset):
+    """
+    Dataset reading resized and cropped uint8 images from memory-mapped cache file
+    """
+    def __init__(self, cache_path: str, rows: list) -> None:
+        self.cache_path = cache_path
+        self.rows = rows
+        self.images = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx: int):
+        if self.images is None:
+            # map file lazily such that every DataLoader worker opens its own memory map
+            self.images = np.load(self.cache_path, mmap_mode="r")
+        return torch.from_numpy(np.array(self.images[self.rows[idx]]))
+
+class DataPrefetcher():
+    """
+    Wrap DataLoader to copy the next batch to the device on a separate CUDA stream
+    while the current batch is being encoded
+    """
+    def __init__(self, loader: DataLoader) -> None:
+        self.loader = loader
+        self.stream = torch.cuda.Stream() if device == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        next_batch = self.preload(loader_iter)
+        while next_batch is not None:
+            if self.stream is not None:
+                # wait for copy of batch to finish before using it on the default stream
+                torch.cuda.current_stream().wait_stream(self.stream)
+                for tensor in (next_batch if isinstance(next_batch, list) else [next_batch]):
+                    tensor.record_stream(torch.cuda.current_stream())
+            batch = next_batch
+            next_batch = self.preload(loader_iter)
+            yield batch
+
+    def preload(self, loader_iter):
+        """
+        Load next batch and start asynchronous copy to device
+        """
+        batch = next(loader_iter, None)
+        if batch is None:
+            return None
+        if self.stream is None:
+            return self.to_device(batch)
+        with torch.cuda.stream(self.stream):
+            return self.to_device(batch)
+
+    def to_device(self, batch):
+        """
+        Copy batch tensor or list of tensors (e.g. images of different sizes) to device
+        """
+        if isinstance(batch, list):
+            return [tensor.to(device, non_blocking=True) for tensor in batch]
+        return batch.to(device, non_blocking=True)
+
 class Evaluate():
     """
     Base class for evaluation
@@ -22,7 +161,12 @@ class Evaluate():
     def __init__(self, **kwargs) -> None:
         self.experiment_folder = os.path.join("data/results", kwargs.get("experiment_name", "default-experiment"))
         self.experiment_name = kwargs.get("experiment_name", "default-experiment")
+        self.rank = kwargs.get("rank", None) or 0
+        self.world_size = kwargs.get("world_size", 1)
         self.hyperparameters = self.load_hyperparameters()
+        self.results_df = None
+        # set by evaluations which stream rows to file instead of collecting them in result_dict
+        self.results_path = None
 
 
     def load_hyperparameters(self):
@@ -32,21 +176,29 @@ class Evaluate():
         with open(os.path.join(self.experiment_folder, "hyperparameters.json"), "r") as f:
             return json.load(f)
         
+    def load_prompt_folders(self):
+        """
+        List prompt-specific folders of experiment assigned to this rank, sorted by prompt id
+        """
+        # DirEntry.is_dir() is answered from the directory listing without additional stat calls
+        with os.scandir(self.experiment_folder) as entries:
+            return sorted(entry.path for entry in entries if entry.is_dir())[self.rank::self.world_size]
+
     def load_prompts(self, folder: str):
         """
         Load prompts from given prompt-specific folder containing generated images
         """
-        with open(os.path.join(folder, "prompts.csv"), "r") as f:
-            orig_prompts = f.read().splitlines()
-            prompts = []
-            for prompt_line in orig_prompts:
+        # collect lines of (multi-line) prompts in buffers and join them once at the end
+        buffers = []
+        with open(os.path.join(folder, "prompts.csv"), "r", encoding="utf-8") as f:
+            for prompt_line in f:
+                prompt_line = prompt_line.rstrip("\r\n")
                 if prompt_line.startswith("optimized_prompt") or prompt_line.startswith("user_prompt"):
-                    prompts.append(prompt_line.split("\t")[-1])
+                    buffers.append([prompt_line.split("\t")[-1]])
                 else:
-                    prompts[-1] += prompt_line
-        
+                    buffers[-1].append(prompt_line)
 
-        return prompts
+        return ["".join(buffer) for buffer in buffers]
 
     def load_captions(self, folder: str):
         """
@@ -86,9 +238,206 @@ class Evaluate():
         """
         raise NotImplementedError
 
+    def build_results_df(self):
+        """
+        Build results DataFrame from result dict (or streamed result file) in one go, storing prompts as pyarrow strings
+        """
+        dtypes = {"user_prompt": "string[pyarrow]", "optimized_prompt": "string[pyarrow]"}
+        if self.results_path is not None:
+            return pd.read_csv(self.results_path, sep="\t", keep_default_na=False, dtype=dtypes)
+        return pd.DataFrame(self.result_dict).astype(dtypes)
+
+    def write_results(self, file_name: str):
+        """
+        Write result dict row by row to TSV file in experiment folder, without building a DataFrame
+        """
+        file_name = shard_file_name(file_name, self.rank, self.world_size)
+        with open(os.path.join(self.experiment_folder, file_name), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+            writer.writerow(self.result_dict.keys())
+            writer.writerows(zip(*self.result_dict.values(), strict=True))
+
+    @contextlib.contextmanager
+    def stream_results(self, file_name: str, columns: list):
+        """
+        Open TSV file in experiment folder and yield csv writer, so rows of each prompt folder are written as they are evaluated
+        """
+        self.results_path = os.path.join(self.experiment_folder, shard_file_name(file_name, self.rank, self.world_size))
+        with open(self.results_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+            writer.writerow(columns)
+            yield writer
+
     def return_df(self):
+        # DataFrame is only built when requested, e.g. to combine results of multiple evaluations
+        if self.results_df is None:
+            self.results_df = self.build_results_df()
         return self.results_df
 
+class CLIPEncoder():
+    """
+    CLIP model encoding images and texts in batches, shared by CLIP-based evaluations
+    """
+    def __init__(self, **kwargs) -> None:
+        experiment_folder = os.path.join("data/results", kwargs.get("experiment_name", "default-experiment"))
+
+        # Load CLIP model
+        self.model, _, self.preprocess = open_clip.create_model_and_transforms('ViT-B-32', pretrained='laion2b_s34b_b79k')
+        self.model = self.model.to(device).eval()
+        self.tokenizer = open_clip.get_tokenizer('ViT-B-32')
+        self.batch_size = kwargs.get("batch_size", 256)
+        self.num_workers = kwargs.get("num_workers", 4)
+        # encoder outputs are half precision under autocast and are collected in contiguous fp16 buffers on GPU,
+        # normalization and scoring are done in full precision
+        self.feature_dtype = torch.float16 if device == 'cuda' else torch.float32
+        self.cache_images = kwargs.get("cache_images", False)
+        # every rank caches images of its own shard of prompt folders
+        rank, world_size = kwargs.get("rank", None) or 0, kwargs.get("world_size", 1)
+        self.cache_path = os.path.join(experiment_folder, shard_file_name("preprocessed_images.npy", rank, world_size))
+        self.cache_index_path = os.path.join(experiment_folder, shard_file_name("preprocessed_images.json", rank, world_size))
+
+        # optionally decode images in DataLoader workers and resize/normalize them on GPU
+        self.gpu_preprocess = kwargs.get("gpu_preprocess", False) and device == 'cuda'
+        image_size = self.model.visual.image_size
+        self.gpu_transform = torch.nn.Sequential(
+            transforms.ConvertImageDtype(torch.float32),
+            transforms.Resize(image_size[0], interpolation=transforms.InterpolationMode.BICUBIC, antialias=True),
+            transforms.CenterCrop(image_size),
+            transforms.Normalize(getattr(self.model.visual, "image_mean", None) or open_clip.OPENAI_DATASET_MEAN,
+                                 getattr(self.model.visual, "image_std", None) or open_clip.OPENAI_DATASET_STD),
+        )
+        # cached images are stored as uint8 after resizing and cropping, conversion and normalization are done on device
+        self.cache_preprocess = transforms.Compose(self.preprocess.transforms[:-2] + [transforms.PILToTensor()])
+        self.cache_normalize = torch.nn.Sequential(self.gpu_transform[0], self.gpu_transform[-1])
+
+        # optionally compile encoders into fused kernels, batches are padded to keep input shapes static
+        self.compile = kwargs.get("compile", False)
+        self.encode_image_fn = self.model.encode_image
+        self.encode_text_fn = self.model.encode_text
+        if self.compile:
+            self.encode_image_fn = torch.compile(self.model.encode_image, mode="reduce-overhead")
+            self.encode_text_fn = torch.compile(self.model.encode_text, mode="reduce-overhead")
+
+    def autocast(self):
+        """
+        Run CLIP forward passes in half precision on GPU
+        """
+        return torch.autocast(device_type=device, dtype=torch.float16, enabled=device == 'cuda')
+
+    def encode_batch(self, encode_fn, batch):
+        """
+        Encode batch of images or tokens, padding incomplete batches to full batch size for compiled encoders
+        """
+        batch_len = len(batch)
+        if self.compile and batch_len < self.batch_size:
+            batch = torch.cat([batch, batch.new_zeros((self.batch_size - batch_len, *batch.shape[1:]))])
+        with self.autocast():
+            return encode_fn(batch)[:batch_len]
+
+    def encode_image_paths(self, image_paths: list):
+        """
+        Load, preprocess and encode images in batches, preprocessing is done by DataLoader workers
+        """
+        collate_fn = None
+        if self.cache_images:
+            dataset = self.load_cached_images(image_paths)
+        elif self.gpu_preprocess:
+            # decoded images may differ in size and are therefore batched as lists
+            dataset = DecodedImageDataset(image_paths)
+            collate_fn = list
+        else:
+            dataset = ImageDataset(image_paths, self.preprocess)
+        loader = DataLoader(dataset, batch_size=self.batch_size, num_workers=self.num_workers, pin_memory=device == 'cuda', collate_fn=collate_fn)
+        images_features = torch.empty((len(image_paths), self.model.visual.output_dim), device=device, dtype=self.feature_dtype)
+        start = 0
+        for batch in tqdm(DataPrefetcher(loader), desc="Encoding images"):
+            if isinstance(batch, list):
+                batch = self.transform_images(batch)
+            elif self.cache_images:
+                batch = self.cache_normalize(batch)
+            images_features[start:start + len(batch)] = self.encode_batch(self.encode_image_fn, batch)
+            start += len(batch)
+        images_features = images_features.float()
+        images_features /= images_features.norm(dim=-1, keepdim=True)
+        return images_features
+
+    def transform_images(self, images: list):
+        """
+        Resize and normalize list of decoded images on device, images of same size are transformed together as one batch
+        """
+        groups = {}
+        for idx, image in enumerate(images):
+            groups.setdefault(image.shape, []).append(idx)
+        batch = None
+        for indices in groups.values():
+            # images of uncommon sizes end up in groups of one
+            transformed = self.gpu_transform(torch.stack([images[idx] for idx in indices]))
+            if batch is None:
+                batch = transformed.new_empty((len(images), *transformed.shape[1:]))
+            # keep original order of images in batch
+            batch[torch.tensor(indices, dtype=torch.long, device=batch.device)] = transformed
+        return batch
+
+    def load_cached_images(self, image_paths: list):
+        """
+        Return dataset of preprocessed images from experiment cache,
+        (re-)creating cache if it does not contain all requested images or images changed on disk
+        """
+        # cache index stores size and modification time of every cached image to detect regenerated images
+        image_stats = {}
+        for path in image_paths:
+            stat = os.stat(path)
+            image_stats[path] = [stat.st_size, stat.st_mtime_ns]
+
+        cached_stats = {}
+        if os.path.exists(self.cache_path) and os.path.exists(self.cache_index_path):
+            with open(self.cache_index_path, "r") as f:
+                cached_stats = json.load(f)
+            if not isinstance(cached_stats, dict) or np.load(self.cache_path, mmap_mode="r").dtype != np.uint8:
+                # cache written by older version without image stats or with normalized float images
+                cached_stats = {}
+        cached_rows = {path: row for row, path in enumerate(cached_stats)}
+
+        if not all(cached_stats.get(path) == stats for path, stats in image_stats.items()):
+            # remove stale index first, such that an interrupted rebuild never leaves index and images out of sync
+            if os.path.exists(self.cache_index_path):
+                os.remove(self.cache_index_path)
+
+            # resize and crop all images once and store them in single memory-mapped file
+            unique_paths = list(image_stats)
+            loader = DataLoader(ImageDataset(unique_paths, self.cache_preprocess), batch_size=self.batch_size, num_workers=self.num_workers)
+            tmp_cache_path = self.cache_path + ".tmp"
+            images = np.lib.format.open_memmap(tmp_cache_path, mode="w+", dtype=np.uint8,
+                                               shape=(len(unique_paths), 3, *self.model.visual.image_size))
+            start = 0
+            for batch in tqdm(loader, desc="Caching preprocessed images"):
+                images[start:start + len(batch)] = batch.numpy()
+                start += len(batch)
+            images.flush()
+            del images
+
+            # move completed files into place, index last
+            tmp_cache_index_path = self.cache_index_path + ".tmp"
+            with open(tmp_cache_index_path, "w") as f:
+                json.dump(image_stats, f)
+            os.replace(tmp_cache_path, self.cache_path)
+            os.replace(tmp_cache_index_path, self.cache_index_path)
+            cached_rows = {path: row for row, path in enumerate(unique_paths)}
+
+        return CachedImageDataset(self.cache_path, [cached_rows[path] for path in image_paths])
+
+    def encode_texts(self, texts: list):
+        """
+        Tokenize and encode texts in batches
+        """
+        texts_features = torch.empty((len(texts), self.model.visual.output_dim), device=device, dtype=self.feature_dtype)
+        for start in range(0, len(texts), self.batch_size):
+            tokens = self.tokenizer(texts[start:start + self.batch_size]).to(device)
+            texts_features[start:start + len(tokens)] = self.encode_batch(self.encode_text_fn, tokens)
+        texts_features = texts_features.float()
+        texts_features /= texts_features.norm(dim=-1, keepdim=True)
+        return texts_features
+
 class CLIPScore(Evaluate):
     """
     Evaluate generated images using CLIPScore-based metrics
@@ -96,12 +445,9 @@ class CLIPScore(Evaluate):
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
         
-        # Load CLIP model
-        self.model, _, self.preprocess = open_clip.create_model_and_transforms('ViT-B-32', pretrained='laion2b_s34b_b79k')
-        self.model = self.model.to(device)
-        self.tokenizer = open_clip.get_tokenizer('ViT-B-32')
+        # CLIP encoder can be shared with other CLIP-based evaluations
+        self.clip_encoder = kwargs.get("clip_encoder", None) or CLIPEncoder(**kwargs)
 
-        self.results_df = pd.DataFrame(columns=["prompt_id", "image_id", "clip_score", "user_prompt", "optimized_prompt", "caption", "image_path"], index=["prompt_id", "image_id"])
         self.result_dict = {
                 "prompt_id": [],
                 "image_id": [],
@@ -112,70 +458,59 @@ class CLIPScore(Evaluate):
                 "image_path": [],
             }
 
-    def encode_images(self, images):
-        image = torch.stack([self.preprocess(image) for image in images]).to(device)
-        images_features = self.model.encode_image(image)
-        images_features /= images_features.norm(dim=-1, keepdim=True)
-        return images_features
-        
     def evaluate(self):
         """
         Evaluate image using CLIP
+        Prompts and image paths of all prompt folders are collected first, such that images and
+        user prompts can be encoded in large batches across folders
         """
+        # unique user prompts, mapped to their row in the encoded text features
+        user_prompts = {}
+        # index of user prompt belonging to each image
+        text_idx = []
+
         # iterate over all prompts/generations of experiment
-        for prompt_folder in tqdm(os.listdir(self.experiment_folder)):
-            prompt_folder = os.path.join(self.experiment_folder, prompt_folder)
-            if not os.path.isdir(prompt_folder):
-                continue
+        for prompt_folder in tqdm(self.load_prompt_folders()):
             prompts = self.load_prompts(prompt_folder)
             captions = self.load_captions(prompt_folder)
+            prompt_id = int(os.path.basename(prompt_folder))
 
-            with torch.no_grad():
-                # Tokenize and encode user prompt
-                user_prompt = self.tokenizer([prompts[0]]).to(device)
-                user_prompt_features = self.model.encode_text(user_prompt)
-                user_prompt_features /= user_prompt_features.norm(dim=-1, keepdim=True)
-
-                # load and encode generated images
-                raw_images = [Image.open(os.path.join(prompt_folder, f"image_{image_idx}.png")) for image_idx in range(len(prompts))]
-                images_features = self.encode_images(raw_images)
-
-                # calculate CLIP-based similarity score
-                #scores = (100.0 * images_features @ user_prompt_features.T).data.cpu().squeeze(-1).numpy().tolist()
-                scores = (2.5 * torch.max(torch.zeros(len(images_features)), torch.cosine_similarity(user_prompt_features, images_features, dim=-1).data.cpu()).numpy()).tolist()
-
-
-            # save results to global dict
-            self.result_dict["prompt_id"].extend([int(prompt_folder.split("/")[-1])] * len(prompts))
+            # save results to global dict, CLIP scores are added after encoding
+            self.result_dict["prompt_id"].extend([prompt_id] * len(prompts))
             self.result_dict["image_id"].extend(list(range(len(prompts))))
-            self.result_dict["clip_score"].extend(scores)
             self.result_dict["user_prompt"].extend([prompts[0]] * len(prompts))
             self.result_dict["optimized_prompt"].extend(prompts)
             self.result_dict["caption"].extend(captions)
             self.result_dict["image_path"].extend([os.path.join(prompt_folder, f"image_{image_idx}.png") for image_idx in range(len(prompts))])
+            user_prompt_idx = user_prompts.setdefault(prompts[0], len(user_prompts))
+            text_idx.extend([user_prompt_idx] * len(prompts))
 
             if os.path.exists(os.path.join(prompt_folder, f"original_image.png")):
-                # calculate CLIP-based similarity score for original reference image if available (e.g. COCO caption dataset)
-                raw_image = Image.open(os.path.join(prompt_folder, f"original_image.png"))
-                image_features = self.encode_images([raw_image])
-                score = (2.5 * torch.max(torch.zeros(1), torch.cosine_similarity(user_prompt_features, image_features, dim=-1).data.cpu()).numpy()).tolist()[0]
-                self.result_dict["prompt_id"].append(int(prompt_folder.split("/")[-1]))
+                # add original reference image if available (e.g. COCO caption dataset)
+                self.result_dict["prompt_id"].append(prompt_id)
                 self.result_dict["image_id"].append(-1)
-                self.result_dict["clip_score"].append(score)
                 self.result_dict["user_prompt"].append(prompts[0])
                 self.result_dict["optimized_prompt"].append(prompts[0])
                 self.result_dict["caption"].append("")
                 self.result_dict["image_path"].append(os.path.join(prompt_folder, f"original_image.png"))
+                text_idx.append(user_prompt_idx)
 
-            # delete some objects due to OOM issues
-            del user_prompt, user_prompt_features, images_features, raw_images
+        with torch.inference_mode():
+            # encode user prompts and all images of experiment
+            user_prompt_features = self.clip_encoder.encode_texts(list(user_prompts))
+            images_features = self.clip_encoder.encode_image_paths(self.result_dict["image_path"])
+
+            # calculate CLIP-based similarity score for all images in one batched product
+            similarities = feature_similarity(images_features, user_prompt_features[torch.tensor(text_idx, dtype=torch.long, device=device)])
+            scores = (2.5 * torch.clamp(similarities, min=0)).cpu().tolist()
+
+        self.result_dict["clip_score"] = scores
 
     def save_results(self):
         """
         Save evaluation results to file
         """
-        self.results_df = pd.DataFrame.from_dict(self.result_dict)
-        self.results_df.to_csv(os.path.join(self.experiment_folder, f"results_clipscore_{self.experiment_name.split('/')[-1]}.tsv"), index=False, sep="\t")
+        self.write_results(f"results_clipscore_{self.experiment_name.split('/')[-1]}.tsv")
 
 class ImageSimilarity(Evaluate):
     """
@@ -184,9 +519,8 @@ class ImageSimilarity(Evaluate):
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
 
-        self.encode_images = CLIPScore(**kwargs).encode_images
-        self.cos = torch.nn.CosineSimilarity(dim=0)
-        self.results_df = pd.DataFrame(columns=["prompt_id", "image_id", "img_sim_score", "user_prompt", "optimized_prompt", "caption", "image_path"], index=["prompt_id", "image_id"])
+        # CLIP encoder can be shared with other CLIP-based evaluations
+        self.clip_encoder = kwargs.get("clip_encoder", None) or CLIPEncoder(**kwargs)
         self.result_dict = {
                 "prompt_id": [],
                 "image_id": [],
@@ -197,9 +531,6 @@ class ImageSimilarity(Evaluate):
                 "image_path": [],
             }
 
-    def cos_similarity(self, features_1, features_2):
-        return self.cos(features_1.flatten(), features_2.flatten())
-
     def evaluate(self):
         """
         Evaluate similarity between the original image and the first generated image and the
@@ -209,42 +540,42 @@ class ImageSimilarity(Evaluate):
         The lower the score, the more similar the images are.
         """
 
+        original_image_paths = []
+        # index of original image belonging to each generated image
+        original_idx = []
+
         # iterate over all prompts/generations of experiment
-        for prompt_folder in tqdm(os.listdir(self.experiment_folder)):
-            prompt_folder = os.path.join(self.experiment_folder, prompt_folder)
-            if not os.path.isdir(prompt_folder):
-                continue
+        for prompt_folder in tqdm(self.load_prompt_folders()):
             prompts = self.load_prompts(prompt_folder)
             captions = self.load_captions(prompt_folder)
+            prompt_id = int(os.path.basename(prompt_folder))
 
-            with torch.no_grad():
-                # load and encode generated images
-                original_image = Image.open(os.path.join(prompt_folder, "original_image.png"))
-                images = [Image.open(os.path.join(prompt_folder, f"image_{image_idx}.png")) for image_idx in range(len(prompts))]
-                original_image_features = self.encode_images([original_image])
-                images_features = self.encode_images(images)
-
-                # calculate image similarity
-                scores = torch.stack([self.cos_similarity(original_image_features, features) for features in images_features])
-                scores = scores.tolist()
-            # delete some objects due to OOM issues
-            del images, images_features, original_image, original_image_features
-
-            # save results to global dict
-            self.result_dict["prompt_id"].extend([int(prompt_folder.split("/")[-1])] * len(prompts))
+            # save results to global dict, similarity scores are added after encoding
+            self.result_dict["prompt_id"].extend([prompt_id] * len(prompts))
             self.result_dict["image_id"].extend(list(range(len(prompts))))
-            self.result_dict["img_sim_score"].extend(scores)
             self.result_dict["user_prompt"].extend([prompts[0]] * len(prompts))
             self.result_dict["optimized_prompt"].extend(prompts)
             self.result_dict["caption"].extend(captions)
             self.result_dict["image_path"].extend([os.path.join(prompt_folder, f"image_{image_idx}.png") for image_idx in range(len(prompts))])
+            original_idx.extend([len(original_image_paths)] * len(prompts))
+            original_image_paths.append(os.path.join(prompt_folder, "original_image.png"))
+
+        with torch.inference_mode():
+            # load and encode generated and original images in one pass
+            features = self.clip_encoder.encode_image_paths(self.result_dict["image_path"] + original_image_paths)
+            images_features = features[:len(self.result_dict["image_path"])]
+            original_images_features = features[len(self.result_dict["image_path"]):]
+
+            # calculate image similarity, features are normalized so cosine similarity reduces to dot product
+            scores = feature_similarity(images_features, original_images_features[torch.tensor(original_idx, dtype=torch.long, device=device)]).cpu().tolist()
+
+        self.result_dict["img_sim_score"] = scores
 
     def save_results(self):
         """
         Save evaluation results to file.
         """
-        self.results_df = pd.DataFrame.from_dict(self.result_dict)
-        self.results_df.to_csv(os.path.join(self.experiment_folder, f"results_image_similarity_{self.experiment_name.split('/')[-1]}.tsv"), index=False, sep="\t")
+        self.write_results(f"results_image_similarity_{self.experiment_name.split('/')[-1]}.tsv")
 
 class CaptionEvaluation(Evaluate):
     """
@@ -257,60 +588,45 @@ class CaptionEvaluation(Evaluate):
         # Initialize scorers
         self.scorer = Spice()
 
-        self.results_df = pd.DataFrame(
-            columns=["prompt_id", "image_id", "spice_score", "user_prompt", "optimized_prompt", "caption", "image_path"],
-            index=["prompt_id", "image_id"])
-        self.result_dict = {
-            "prompt_id": [],
-            "image_id": [],
-            "spice_score": [],
-            "user_prompt": [],
-            "optimized_prompt": [],
-            "caption": [],
-            "image_path": [],
-        }
+        self.columns = ["prompt_id", "image_id", "spice_score", "user_prompt", "optimized_prompt", "caption", "image_path"]
 
     def evaluate(self):
         """
         Evaluate captions using COCO captions metrics
         """
-        # iterate over all prompts/generations of experiment
-        for prompt_folder in tqdm(os.listdir(self.experiment_folder)):
-            prompt_folder = os.path.join(self.experiment_folder, prompt_folder)
-            if not os.path.isdir(prompt_folder):
-                continue
-            prompts = self.load_prompts(prompt_folder)
-            captions = self.load_captions(prompt_folder)
+        with self.stream_results(f"results_caption_score_{self.experiment_name.split('/')[-1]}.tsv", self.columns) as writer:
+            # iterate over all prompts/generations of experiment
+            for prompt_folder in tqdm(self.load_prompt_folders()):
+                writer.writerows(self.evaluate_folder(prompt_folder))
 
-            original_prompt = prompts[0]
+    def evaluate_folder(self, prompt_folder: str):
+        """
+        Calculate SPICE score of all captions of prompt folder and return result rows
+        """
+        prompts = self.load_prompts(prompt_folder)
+        captions = self.load_captions(prompt_folder)
 
-            scores = []
+        original_prompt = prompts[0]
 
-            # calculate caption similarity
-            for idx, caption in enumerate(captions):
-                gts = {idx: [original_prompt]}
-                res = {idx: [caption]}
+        scores = []
 
-                avg_score, _ = self.scorer.compute_score(gts, res)
-                scores.append(avg_score)
+        # calculate caption similarity
+        for idx, caption in enumerate(captions):
+            gts = {idx: [original_prompt]}
+            res = {idx: [caption]}
 
-            # save results to global dict
-            self.result_dict["prompt_id"].extend([int(prompt_folder.split("/")[-1])] * len(prompts))
-            self.result_dict["image_id"].extend(list(range(len(prompts))))
-            self.result_dict["spice_score"].extend(scores)
-            self.result_dict["user_prompt"].extend([prompts[0]] * len(prompts))
-            self.result_dict["optimized_prompt"].extend(prompts)
-            self.result_dict["caption"].extend(captions)
-            self.result_dict["image_path"].extend(
-                [os.path.join(prompt_folder, f"image_{image_idx}.png") for image_idx in range(len(prompts))])
+            avg_score, _ = self.scorer.compute_score(gts, res)
+            scores.append(avg_score)
+
+        prompt_id = int(prompt_folder.split("/")[-1])
+        image_paths = [os.path.join(prompt_folder, f"image_{image_idx}.png") for image_idx in range(len(prompts))]
+        return zip([prompt_id] * len(prompts), range(len(prompts)), scores, [original_prompt] * len(prompts),
+                   prompts, captions, image_paths, strict=True)
 
     def save_results(self):
         """
-        Save evaluation results to file
+        Results are already written to file while evaluating
         """
-        self.results_df = pd.DataFrame.from_dict(self.result_dict)
-        self.results_df.to_csv(os.path.join(self.experiment_folder, f"results_caption_score_{self.experiment_name.split('/')[-1]}.tsv"),
-                               index=False, sep="\t")
 
 
 class LLMEvaluation(Evaluate):
@@ -321,84 +637,63 @@ class LLMEvaluation(Evaluate):
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
 
-        # Initialize scorers
-        self.results_df = pd.DataFrame(
-            columns=["prompt_id", "image_id", "terminated", "best_image", "user_prompt", "optimized_prompt", "caption", "image_path"],
-            index=["prompt_id", "image_id"])
-        self.result_dict = {
-            "prompt_id": [],
-            "image_id": [],
-            "terminated": [],
-            "best_image": [],
-            "user_prompt": [],
-            "optimized_prompt": [],
-            "caption": [],
-            "image_path": [],
-        }
+        self.columns = ["prompt_id", "image_id", "terminated", "best_image", "user_prompt", "optimized_prompt", "caption", "image_path"]
 
     def evaluate(self):
         """
         Evaluate captions using COCO captions metrics
         """
-        # iterate over all prompts/generations of experiment
-        for prompt_folder in tqdm(os.listdir(self.experiment_folder)):
-            prompt_folder = os.path.join(self.experiment_folder, prompt_folder)
-            if not os.path.isdir(prompt_folder):
-                continue
-            prompts = self.load_prompts(prompt_folder)
-            captions = self.load_captions(prompt_folder)
-            terminated_at, best_image_num = self.terminated_and_best_image(prompt_folder)
-
-            original_prompt = prompts[0]
-
-            terminated = []
-            best_image = []
-            # calculate caption similarity
-            for idx in range(len(captions)):
-                if idx == int(terminated_at):
-                    terminated.append(1)
-                else:
-                    terminated.append(0)
-                if idx == int(best_image_num):
-                    best_image.append(1)
-                else:
-                    best_image.append(0)
+        with self.stream_results(f"llm_eval_{self.experiment_name.split('/')[-1]}.tsv", self.columns) as writer:
+            # iterate over all prompts/generations of experiment
+            for prompt_folder in tqdm(self.load_prompt_folders()):
+                writer.writerows(self.evaluate_folder(prompt_folder))
 
+    def evaluate_folder(self, prompt_folder: str):
+        """
+        Mark image the LLM terminated at and image it selected as best, return result rows of prompt folder
+        """
+        prompts = self.load_prompts(prompt_folder)
+        captions = self.load_captions(prompt_folder)
+        terminated_at, best_image_num = self.terminated_and_best_image(prompt_folder)
+
+        terminated = []
+        best_image = []
+        for idx in range(len(captions)):
+            if idx == int(terminated_at):
+                terminated.append(1)
+            else:
+                terminated.append(0)
+            if idx == int(best_image_num):
+                best_image.append(1)
+            else:
+                best_image.append(0)
 
-            # save results to global dict
-            self.result_dict["prompt_id"].extend([int(prompt_folder.split("/")[-1])] * len(prompts))
-            self.result_dict["image_id"].extend(list(range(len(prompts))))
-            self.result_dict["terminated"].extend(terminated)
-            self.result_dict["best_image"].extend(best_image)
-            self.result_dict["user_prompt"].extend([prompts[0]] * len(prompts))
-            self.result_dict["optimized_prompt"].extend(prompts)
-            self.result_dict["caption"].extend(captions)
-            self.result_dict["image_path"].extend(
-                [os.path.join(prompt_folder, f"image_{image_idx}.png") for image_idx in range(len(prompts))])
+        prompt_id = int(prompt_folder.split("/")[-1])
+        image_paths = [os.path.join(prompt_folder, f"image_{image_idx}.png") for image_idx in range(len(prompts))]
+        return zip([prompt_id] * len(prompts), range(len(prompts)), terminated, best_image, [prompts[0]] * len(prompts),
+                   prompts, captions, image_paths, strict=True)
 
     def save_results(self):
         """
-        Save evaluation results to file
+        Results are already written to file while evaluating
         """
-        self.results_df = pd.DataFrame.from_dict(self.result_dict)
-        self.results_df.to_csv(os.path.join(self.experiment_folder, f"llm_eval_{self.experiment_name.split('/')[-1]}.tsv"),
-                               index=False, sep="\t")
 
 
-if __name__ == "__main__":
-
-    argparser = argparse.ArgumentParser()
-    argparser.add_argument("--experiment_name", type=str, default="default-experiment",
-                           help="Name of experiment to evaluate")
-    argparser.add_argument("--evaluation_method", type=str, default="clipscore", help="Evaluation method to use",
-                           choices=["clipscore", "image_similarity", "caption_score", "llm_eval", "all"])
-    kwargs = vars(argparser.parse_args())
+def run_evaluation(rank: int, kwargs: dict):
+    """
+    Run evaluation(s) on shard of prompt folders assigned to given rank
+    """
+    kwargs = {**kwargs, "rank": rank}
+    if device == 'cuda':
+        # spread ranks over all visible GPUs
+        torch.cuda.set_device(rank % torch.cuda.device_count())
 
     if kwargs["evaluation_method"] == "all":
 
-        # Initialize all evaluations
-        clip_eval = CLIPScore(**kwargs)
-        img_sim_eval = ImageSimilarity(**kwargs)
+        # Initialize all evaluations, CLIP-based evaluations share one CLIP model
+        clip_encoder = CLIPEncoder(**kwargs)
+        clip_eval = CLIPScore(clip_encoder=clip_encoder, **kwargs)
+        img_sim_eval = ImageSimilarity(clip_encoder=clip_encoder, **kwargs)
         caption_eval = CaptionEvaluation(**kwargs)
         llm_eval = LLMEvaluation(**kwargs)
 
@@ -420,7 +715,7 @@ if __name__ == "__main__":
             else:
                 all_results = pd.merge(all_results, results, on=joiner, how='left')
         # Save the results to csv
-        all_results.to_csv(os.path.join(os.getcwd(), f'data/results/{kwargs["experiment_name"]}', f'evaluation.tsv'),
+        all_results.to_csv(os.path.join(os.getcwd(), f'data/results/{kwargs["experiment_name"]}', shard_file_name('evaluation.tsv', rank, kwargs["world_size"])),
                                index=False, sep="\t")
 
     else:
@@ -437,4 +732,40 @@ if __name__ == "__main__":
 
         evaluation.evaluate()
         evaluation.save_results()
-        test = evaluation.return_df()
+
+
+if __name__ == "__main__":
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--experiment_name", type=str, default="default-experiment",
+                           help="Name of experiment to evaluate")
+    argparser.add_argument("--evaluation_method", type=str, default="clipscore", help="Evaluation method to use",
+                           choices=["clipscore", "image_similarity", "caption_score", "llm_eval", "all"])
+    argparser.add_argument("--batch_size", type=int, default=256, help="Batch size for encoding images and prompts")
+    argparser.add_argument("--num_workers", type=int, default=4, help="Number of DataLoader workers for image preprocessing")
+    argparser.add_argument("--compile", action="store_true", help="Compile CLIP encoders with torch.compile")
+    argparser.add_argument("--gpu_preprocess", action="store_true",
+                           help="Decode images with torchvision in DataLoader workers and resize/normalize them on GPU")
+    argparser.add_argument("--cache_images", action="store_true",
+                           help="Cache preprocessed images of experiment in single memory-mapped file to skip decoding and resizing in later runs")
+    argparser.add_argument("--world_size", type=int, default=1, help="Number of processes to shard prompt folders over")
+    argparser.add_argument("--rank", type=int, default=None,
+                           help="Rank of this process, if not set all ranks are spawned locally (one per visible GPU)")
+    argparser.add_argument("--merge_shards", action="store_true", help="Only merge result shards written by previous runs of all ranks")
+    kwargs = vars(argparser.parse_args())
+    if kwargs["world_size"] < 1:
+        argparser.error("--world_size must be at least 1")
+    if kwargs["rank"] is not None and not 0 <= kwargs["rank"] < kwargs["world_size"]:
+        argparser.error(f"--rank must be in [0, {kwargs['world_size']}) for --world_size {kwargs['world_size']}")
+
+    if kwargs["merge_shards"]:
+        merge_result_shards(os.path.join("data/results", kwargs["experiment_name"]), kwargs["world_size"])
+    elif kwargs["rank"] is not None:
+        # single rank, e.g. launched as one of multiple jobs, shards are merged afterwards with --merge_shards
+        run_evaluation(kwargs["rank"], kwargs)
+    else:
+        if kwargs["world_size"] > 1:
+            torch.multiprocessing.spawn(run_evaluation, args=(kwargs,), nprocs=kwargs["world_size"])
+        else:
+            run_evaluation(0, kwargs)
+        merge_result_shards(os.path.join("data/results", kwargs["experiment_name"]), kwargs["world_size"])
@@ -1,10 +1,18 @@
 import os, sys
 import enum
+import string
+import asyncio
+import json
+import hashlib
+import sqlite3
 import openai
 from transformers import pipeline
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import time
 
+# placeholders in templates which are substituted when building prompts
+TEMPLATE_PLACEHOLDERS = ["USER_PROMPT", "IMAGE_CAPTION", "PREVIOUS_PROMPTS", "CAPTIONS"]
+
 class LanguageModelType(enum.Enum):
     chat_gpt = "chat_gpt"
     davinci_003 = "davinci-003"
@@ -45,6 +53,16 @@ class LanguageModel():
         self.template = self.load_template(kwargs.get("template", "config/templates/default_template.txt"))
         self.similarity_template = self.load_template(kwargs.get("similarity_template", "config/templates/default_similarity_template.txt"))
         self.best_image_template = self.load_template(kwargs.get("best_image_template", "config/templates/default_best_image_template.txt"))
+        self._template = self.compile_template(self.template)
+        self._similarity_template = self.compile_template(self.similarity_template)
+        self._best_image_template = self.compile_template(self.best_image_template)
+
+        # Optional on-disk cache of responses, keyed by hash of model and prompt
+        self.cache = None
+        if kwargs.get("cache_path", None) is not None:
+            os.makedirs(os.path.dirname(kwargs["cache_path"]) or ".", exist_ok=True)
+            self.cache = sqlite3.connect(kwargs["cache_path"])
+            self.cache.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT)")
     
     def check_similarity(self, user_prompt: str, image_caption: str):
         """
@@ -59,7 +77,7 @@ class LanguageModel():
         """
 
         similarity_prompt = self.get_similarity_prompt(user_prompt, image_caption)
-        similarity_response = self.query_language_model(similarity_prompt)
+        similarity_response = self.cached_query([similarity_prompt])[0]
 
         return 1 if "yes" in similarity_response.lower() else 0
 
@@ -77,9 +95,29 @@ class LanguageModel():
         """
 
         LLM_prompt = self.get_language_prompt(user_prompt, image_caption, previous_prompts)
-        LLM_response = self.query_language_model(LLM_prompt)
+        LLM_response = self.cached_query([LLM_prompt])[0]
 
         return LLM_response
+
+    def check_similarity_and_optimize(self, user_prompt: str, image_caption: str, previous_prompts: list = []):
+        """
+        Check similarity between user prompt and image caption and generate optimized prompt
+        Both queries are independent and are therefore sent as one batch
+
+        Parameters:
+            user_prompt (str): user prompt
+            image_caption (str): image caption
+            previous_prompts (list): list of prompts previously generated by model
+        Returns:
+            bool: True if caption is sufficiently similar to user prompt, False otherwise
+            str: optimized prompt
+        """
+
+        similarity_prompt = self.get_similarity_prompt(user_prompt, image_caption)
+        LLM_prompt = self.get_language_prompt(user_prompt, image_caption, previous_prompts)
+        similarity_response, LLM_response = self.cached_query([similarity_prompt, LLM_prompt])
+
+        return 1 if "yes" in similarity_response.lower() else 0, LLM_response
     
     def select_best_image(self, user_prompt: str, captions: list):
         """
@@ -93,7 +131,7 @@ class LanguageModel():
         """
 
         best_image_prompt = self.get_best_image_prompt(user_prompt, captions)
-        best_image_response = self.query_language_model(best_image_prompt).lower()
+        best_image_response = self.cached_query([best_image_prompt])[0].lower()
 
         if "1" in best_image_response or "one" in best_image_response:
             best_image_idx = 0
@@ -135,6 +173,23 @@ class LanguageModel():
         
         return template
 
+    def compile_template(self, template: str):
+        """
+        Compile template into string.Template, replacing <PLACEHOLDER> tags by ${placeholder} fields
+
+        Parameters:
+            template (str): template text
+        Returns:
+            string.Template: compiled template
+        """
+
+        # escape literal $ in template text
+        template = template.replace("$", "$$")
+        for placeholder in TEMPLATE_PLACEHOLDERS:
+            template = template.replace(f"<{placeholder}>", f"${{{placeholder.lower()}}}")
+
+        return string.Template(template)
+
     def get_language_prompt(self, user_prompt: str, image_caption: str, previous_prompts: list = []):
         """
         Generate language prompt given original user prompt, image caption, and possibly previous prompts
@@ -147,19 +202,13 @@ class LanguageModel():
             str: prompt for language model
         """
 
-        # Replace <USER_PROMPT> in template with user prompt
-        prompt = self.template.replace("<USER_PROMPT>", user_prompt)
-        # Replace <IMAGE_CAPTION> in template with image caption
-        prompt = prompt.replace("<IMAGE_CAPTION>", image_caption)
-        # Add optional text for previous prompts
-        if len(previous_prompts) > 0:
-            #TODO implement properly depending on ultimate syntax for previous prompt definition
-            previous_prompt = ""
-            for prompt in previous_prompts:
-                prompt_prefix = "" #TODO: add prefix for previous prompts
-                prompt_suffix = "" #TODO: add suffix for previous prompts
-                previous_prompt += prompt_prefix + prompt + prompt_suffix
-            prompt = prompt.replace("<PREVIOUS_PROMPTS>", previous_prompt)
+        #TODO implement properly depending on ultimate syntax for previous prompt definition
+        prompt_prefix = "" #TODO: add prefix for previous prompts
+        prompt_suffix = "" #TODO: add suffix for previous prompts
+        previous_prompt = "".join(prompt_prefix + p + prompt_suffix for p in previous_prompts)
+
+        # Fill in user prompt, image caption and optional previous prompts
+        prompt = self._template.safe_substitute(user_prompt=user_prompt, image_caption=image_caption, previous_prompts=previous_prompt)
 
         return prompt
     
@@ -174,10 +223,8 @@ class LanguageModel():
             str: prompt for similarity check
         """
 
-        # Replace <USER_PROMPT> in template with user prompt
-        prompt = self.similarity_template.replace("<USER_PROMPT>", user_prompt)
-        # Replace <IMAGE_CAPTION> in template with image caption
-        prompt = prompt.replace("<IMAGE_CAPTION>", image_caption)
+        # Fill in user prompt and image caption
+        prompt = self._similarity_template.safe_substitute(user_prompt=user_prompt, image_caption=image_caption)
 
         return prompt
 
@@ -192,12 +239,9 @@ class LanguageModel():
             str: prompt to select best image
         """
 
-        prompt = self.best_image_template.replace("<USER_PROMPT>", user_prompt)
         # prompt = prompt.replace("<RANGE>", len(captions)+1)
-        captions_prompt = ""
-        for idx, caption in enumerate(captions):
-            captions_prompt += f"{idx+1}. {caption}\n"
-        prompt = prompt.replace("<CAPTIONS>", captions_prompt)
+        captions_prompt = "".join(f"{idx+1}. {caption}\n" for idx, caption in enumerate(captions))
+        prompt = self._best_image_template.safe_substitute(user_prompt=user_prompt, captions=captions_prompt)
 
         return prompt
 
@@ -214,6 +258,63 @@ class LanguageModel():
         """
         
         raise NotImplementedError
+
+    def query_batch(self, prompts: list):
+        """
+        Query language model with list of independent prompts
+        -> may be overwritten by sub-class to send queries concurrently
+
+        Parameters:
+            prompts (list): prompts to query language model with
+        Returns:
+            list: generated texts
+        """
+
+        return [self.query_language_model(prompt) for prompt in prompts]
+
+    def cached_query(self, prompts: list):
+        """
+        Query language model with list of independent prompts, returning cached responses if available
+        Only prompts missing from the cache are sent to the language model (and count towards token usage)
+
+        Parameters:
+            prompts (list): prompts to query language model with
+        Returns:
+            list: generated texts
+        """
+
+        if self.cache is None:
+            return self.query_batch(prompts)
+
+        keys = [self.cache_key(prompt) for prompt in prompts]
+        responses = []
+        for key in keys:
+            row = self.cache.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            responses.append(None if row is None else row[0])
+
+        missing = [idx for idx, response in enumerate(responses) if response is None]
+        if len(missing) > 0:
+            generated = self.query_batch([prompts[idx] for idx in missing])
+            for idx, response in zip(missing, generated):
+                responses[idx] = response
+                self.cache.execute("INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)", (keys[idx], response))
+            self.cache.commit()
+
+        return responses
+
+    def cache_key(self, prompt):
+        """
+        Hash model and prompt (text or list of chat messages) to key for response cache
+        The model class is part of the key such that responses of different models are never mixed up
+
+        Parameters:
+            prompt (str | list): prompt to hash
+        Returns:
+            str: hex digest of model and prompt
+        """
+
+        payload = {"model": type(self).__name__, "prompt": prompt}
+        return hashlib.blake2b(json.dumps(payload, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
     
     def reset(self):
         """
@@ -267,10 +368,8 @@ class ChatGPT(LanguageModel):
 
         message = [{"role": "system", "content": self.role}]
 
-        # Replace <USER_PROMPT> in template with user prompt
-        prompt = self.template.replace("<USER_PROMPT>", user_prompt)
-        # Replace <IMAGE_CAPTION> in template with image caption
-        prompt = prompt.replace("<IMAGE_CAPTION>", image_caption)
+        # Fill in user prompt and image caption
+        prompt = self._template.safe_substitute(user_prompt=user_prompt, image_caption=image_caption)
 
         message.append({"role": "user", "content": prompt})
 
@@ -288,10 +387,8 @@ class ChatGPT(LanguageModel):
         """
         message = [{"role": "system", "content": self.similarity_role}]
 
-        # Replace <USER_PROMPT> in template with user prompt
-        prompt = self.similarity_template.replace("<USER_PROMPT>", user_prompt)
-        # Replace <IMAGE_CAPTION> in template with image caption
-        prompt = prompt.replace("<IMAGE_CAPTION>", image_caption)
+        # Fill in user prompt and image caption
+        prompt = self._similarity_template.safe_substitute(user_prompt=user_prompt, image_caption=image_caption)
 
         message.append({"role": "user", "content": prompt})
 
@@ -313,11 +410,8 @@ class ChatGPT(LanguageModel):
 
         message = [{"role": "system", "content": self.best_image_role.replace("<RANGE>", str(len(captions)))}]
 
-        prompt = self.best_image_template.replace("<USER_PROMPT>", user_prompt)
-        captions_prompt = ""
-        for idx, caption in enumerate(captions):
-            captions_prompt += f"{idx+1}. {caption}\n"
-        prompt = prompt.replace("<CAPTIONS>", captions_prompt)
+        captions_prompt = "".join(f"{idx+1}. {caption}\n" for idx, caption in enumerate(captions))
+        prompt = self._best_image_template.safe_substitute(user_prompt=user_prompt, captions=captions_prompt)
 
         message.append({"role": "user", "content": prompt})
 
@@ -351,6 +445,63 @@ class ChatGPT(LanguageModel):
 
         return generated_prompt['choices'][0]['message']['content']
 
+    async def aquery_language_model(self, prompt: str):
+        """
+        Asynchronously query language model with prompt
+
+        Parameters:
+            prompt (str): prompt to query language model with
+        Returns:
+            str: generated text
+        """
+        error_counter = 0
+        while True:
+            try:
+                generated_prompt = await openai.ChatCompletion.acreate(
+                    model="gpt-3.5-turbo",
+                    messages=prompt)
+                break
+            except Exception as e:
+                print(f"Encountered OpenAI exception {e}")
+                if error_counter > 5:
+                    raise e
+                else:
+                    await asyncio.sleep(60)
+                error_counter += 1
+
+        # requests share a single event loop thread, so no lock is needed here
+        self.token_usage += generated_prompt['usage']['total_tokens']
+
+        return generated_prompt['choices'][0]['message']['content']
+
+    async def aquery_batch(self, prompts: list):
+        """
+        Asynchronously query language model with list of independent prompts
+
+        Parameters:
+            prompts (list): prompts to query language model with
+        Returns:
+            list: generated texts
+        """
+        return await asyncio.gather(*[self.aquery_language_model(prompt) for prompt in prompts])
+
+    def query_batch(self, prompts: list):
+        """
+        Query language model with list of independent prompts concurrently
+
+        Parameters:
+            prompts (list): prompts to query language model with
+        Returns:
+            list: generated texts
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.aquery_batch(prompts))
+
+        # event loop is already running (e.g. in notebook), fall back to sequential queries
+        return super().query_batch(prompts)
+
     def reset(self):
         """
         Optional method to reset model between generations
@@ -382,10 +533,8 @@ class Davinci003(LanguageModel):
             str: prompt for language model
         """
 
-        # Replace <USER_PROMPT> in template with user prompt
-        prompt = self.template.replace("<USER_PROMPT>", user_prompt)
-        # Replace <IMAGE_CAPTION> in template with image caption
-        prompt = prompt.replace("<IMAGE_CAPTION>", image_caption)
+        # Fill in user prompt and image caption
+        prompt = self._template.safe_substitute(user_prompt=user_prompt, image_caption=image_caption)
 
         return prompt
 
@@ -400,10 +549,8 @@ class Davinci003(LanguageModel):
             str: prompt for similarity check
         """
 
-        # Replace <USER_PROMPT> in template with user prompt
-        prompt = self.similarity_template.replace("<USER_PROMPT>", user_prompt)
-        # Replace <IMAGE_CAPTION> in template with image caption
-        prompt = prompt.replace("<IMAGE_CAPTION>", image_caption)
+        # Fill in user prompt and image caption
+        prompt = self._similarity_template.safe_substitute(user_prompt=user_prompt, image_caption=image_caption)
 
         return prompt
 
@@ -20,7 +20,14 @@ class Pipeline:
         """
         self.hyperparameters = kwargs
 
-        self.language_model = load_language_model(**kwargs.get('language_model',{}))
+        experiment_name = kwargs.get('pipeline',{}).get("experiment_name", "default-experiment")
+        self.path = os.path.join("data/results", experiment_name)
+
+        language_model_kwargs = kwargs.get('language_model',{})
+        if language_model_kwargs.get("cache_responses", False):
+            # Cache language model responses in experiment folder
+            language_model_kwargs = {**language_model_kwargs, "cache_path": os.path.join(self.path, "llm_cache.sqlite")}
+        self.language_model = load_language_model(**language_model_kwargs)
         self.image_generator = load_image_generator(**kwargs.get('image_generator',{}))
         self.image_captioning = load_captioning_model(**kwargs.get('image_captioning',{}))
 
@@ -30,8 +37,6 @@ class Pipeline:
         self.demo = kwargs.get('pipeline',{}).get("demo", False)
         # Set-up folder to store generated images and save hyperparameters
         self.image_id = 0
-        experiment_name = kwargs.get('pipeline',{}).get("experiment_name", "default-experiment")
-        self.path = os.path.join("data/results", experiment_name)
         os.makedirs(self.path, exist_ok=True)
         with open(os.path.join(self.path, "hyperparameters.json"), "w") as f:
             def convert_dict2str(dict):
@@ -123,14 +128,19 @@ class Pipeline:
             caption = self.image_captioning.generate_caption(image)
             captions.append(caption)
 
-            # Check termination condition
-            if self.terminate_on_similarity and self.language_model.check_similarity(original_prompt, caption) and terminated == -1:
-                terminated = i
-                if self.pipeline_mode != "full_experiment":
+            if self.terminate_on_similarity and self.pipeline_mode == "full_experiment":
+                # Prompt is optimized regardless of termination, query similarity and optimization together
+                similar, prompt = self.language_model.check_similarity_and_optimize(original_prompt, caption, previous_prompts)
+                if similar and terminated == -1:
+                    terminated = i
+            else:
+                # Check termination condition
+                if self.terminate_on_similarity and self.language_model.check_similarity(original_prompt, caption) and terminated == -1:
+                    terminated = i
                     break
 
-            # Optimize prompt
-            prompt = self.language_model.generate_optimized_prompt(user_prompt, caption, previous_prompts)
+                # Optimize prompt
+                prompt = self.language_model.generate_optimized_prompt(user_prompt, caption, previous_prompts)
             previous_prompts.append(prompt)
 
             # Generate and save image for optimized prompt
@@ -54,6 +54,7 @@ def main():
     p5.add_argument('--system_sim_prompt', default='config/templates/model_role_similarity.txt', type=str, help='Path to system prompt to use for similarity check')
     p5.add_argument('--best_image_template', default='config/templates/chatgpt_best_image_template.txt', type=str, help='Path to template to use for best image selection')
     p5.add_argument('--system_best_image_prompt', default='config/templates/chatgpt_best_image_system_template.txt', type=str, help='Path to system prompt to use for best image selection')
+    p5.add_argument('--cache_responses', default=False, type=bool, help='Whether to cache language model responses in the experiment folder and reuse them for identical prompts')
                         
     args = main_parser.parse_args()
     args = {k:vars(v) for k,v in vars(args).items()}
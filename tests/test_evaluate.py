@@ -0,0 +1,41 @@
+import os
+import json
+import pytest
+from evaluation.evaluate import Evaluate, merge_result_shards
+
+@pytest.fixture
+def experiment(tmp_path, monkeypatch):
+    # experiments are looked up relative to working directory
+    monkeypatch.chdir(tmp_path)
+    experiment_folder = os.path.join("data/results", "test-experiment")
+    os.makedirs(experiment_folder)
+    with open(os.path.join(experiment_folder, "hyperparameters.json"), "w") as f:
+        json.dump({}, f)
+    return Evaluate(experiment_name="test-experiment")
+
+def test_load_multi_line_prompts(experiment):
+    prompt_folder = os.path.join(experiment.experiment_folder, "000000")
+    os.makedirs(prompt_folder)
+    with open(os.path.join(prompt_folder, "prompts.csv"), "w", encoding="utf-8") as f:
+        f.write("user_prompt\ta cat\n"
+                "optimized_prompt_0\ta fluffy cat,\n"
+                " sitting on a mat\n"
+                "optimized_prompt_1\ta cat in the sun\n")
+    assert experiment.load_prompts(prompt_folder) == ["a cat", "a fluffy cat, sitting on a mat", "a cat in the sun"]
+
+def test_merge_result_shards(tmp_path):
+    for rank in range(2):
+        with open(tmp_path / f"results.rank{rank}.tsv", "w") as f:
+            f.write(f"prompt_id\tscore\n{rank}\t0.{rank}\n")
+    merge_result_shards(str(tmp_path), 2)
+    with open(tmp_path / "results.tsv", "r") as f:
+        assert f.read() == "prompt_id\tscore\n0\t0.0\n1\t0.1\n"
+    assert not os.path.exists(tmp_path / "results.rank0.tsv")
+    assert not os.path.exists(tmp_path / "results.rank1.tsv")
+
+def test_merge_result_shards_missing_rank(tmp_path):
+    with open(tmp_path / "results.rank0.tsv", "w") as f:
+        f.write("prompt_id\tscore\n0\t0.0\n")
+    merge_result_shards(str(tmp_path), 2)
+    assert not os.path.exists(tmp_path / "results.tsv")
+    assert os.path.exists(tmp_path / "results.rank0.tsv")
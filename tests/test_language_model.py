@@ -0,0 +1,67 @@
+import pytest
+from model.language_model import LanguageModel
+
+class CountingLanguageModel(LanguageModel):
+    """
+    Language model answering every prompt locally and recording which prompts reached the "API"
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.token_usage = 0
+        self.queried = []
+
+    def query_language_model(self, prompt):
+        self.queried.append(prompt)
+        self.token_usage += 1
+        return f"{type(self).__name__}: {prompt}"
+
+class OtherLanguageModel(CountingLanguageModel):
+    pass
+
+@pytest.fixture
+def templates(tmp_path):
+    paths = {}
+    for name, text in [("template", "Improve <USER_PROMPT> given <IMAGE_CAPTION>, costs $5\n<PREVIOUS_PROMPTS>"),
+                       ("similarity_template", "Does <IMAGE_CAPTION> match <USER_PROMPT>?"),
+                       ("best_image_template", "Which caption matches <USER_PROMPT>?\n<CAPTIONS>")]:
+        paths[name] = str(tmp_path / f"{name}.txt")
+        with open(paths[name], "w") as f:
+            f.write(text)
+    return paths
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "llm_cache.sqlite")
+
+def test_compile_template(templates):
+    language_model = CountingLanguageModel(**templates)
+    prompt = language_model.get_language_prompt("a cat", "a dog", ["first prompt. ", "second prompt."])
+    assert prompt == "Improve a cat given a dog, costs $5\nfirst prompt. second prompt."
+    assert language_model.get_language_prompt("a cat", "a dog") == "Improve a cat given a dog, costs $5\n"
+
+def test_cache_hit_skips_query(templates, cache_path):
+    language_model = CountingLanguageModel(cache_path=cache_path, **templates)
+    response = language_model.cached_query(["prompt"])
+    assert language_model.cached_query(["prompt"]) == response
+    assert language_model.queried == ["prompt"]
+    assert language_model.token_usage == 1
+
+    # cache persists across instances
+    language_model = CountingLanguageModel(cache_path=cache_path, **templates)
+    assert language_model.cached_query(["prompt"]) == response
+    assert language_model.queried == []
+    assert language_model.token_usage == 0
+
+def test_partial_cache_hit_queries_missing_prompts(templates, cache_path):
+    language_model = CountingLanguageModel(cache_path=cache_path, **templates)
+    language_model.cached_query(["cached"])
+    responses = language_model.cached_query(["missing", "cached"])
+    assert responses == ["CountingLanguageModel: missing", "CountingLanguageModel: cached"]
+    assert language_model.queried == ["cached", "missing"]
+
+def test_cache_keys_differ_between_models(templates, cache_path):
+    language_model = CountingLanguageModel(cache_path=cache_path, **templates)
+    other_language_model = OtherLanguageModel(cache_path=cache_path, **templates)
+    assert language_model.cached_query(["prompt"]) == ["CountingLanguageModel: prompt"]
+    assert other_language_model.cached_query(["prompt"]) == ["OtherLanguageModel: prompt"]
+    assert other_language_model.queried == ["prompt"]